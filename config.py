@@ -1,11 +1,26 @@
+import json
+import logging
 import os
+import re
+import tempfile
 
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass
 from enum import StrEnum
+from pathlib import Path
 
-import dacite
 import requests
+import urllib3
 import yaml
+from mashumaro import DataClassDictMixin
+
+# libyaml bindings are much faster, but are not always available
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+logger = logging.getLogger(__name__)
+
+COMMIT_SHA_RE = re.compile(r"[0-9a-f]{40}")
+CACHE_DIR = Path(os.getenv("XDG_CACHE_HOME", "~/.cache")).expanduser() / "udata-front-kit-seo"
 
 
 class DeployEnv(StrEnum):
@@ -15,88 +30,168 @@ class DeployEnv(StrEnum):
 
 
 @dataclass
-class MetaConfig:
+class MetaConfig(DataClassDictMixin):
     keywords: str | None = None
     description: str | None = None
     robots: str | None = None
 
 @dataclass
-class RobotsTxtConfig:
+class RobotsTxtConfig(DataClassDictMixin):
     disallow: list[str] | None = None
 
 @dataclass
-class SitemapXmlConfig:
+class SitemapXmlConfig(DataClassDictMixin):
     topics_pages: list[str] | None = None
     datasets_pages: list[str] | None = None
     dataservices_pages: list[str] | None = None
     static_urls: list[str] | None = None
 
 @dataclass
-class SeoConfig:
+class SeoConfig(DataClassDictMixin):
     canonical_url: str
     meta: MetaConfig | None = None
     sitemap_xml: SitemapXmlConfig | None = None
     robots_txt: RobotsTxtConfig | None = None
 
 @dataclass
-class PageConfig:
+class PageConfig(DataClassDictMixin):
     universe_query: dict
 
 @dataclass
-class DatagouvfrConfig:
+class DatagouvfrConfig(DataClassDictMixin):
     base_url: str
 
 @dataclass
-class StaticPageConfig:
+class StaticPageConfig(DataClassDictMixin):
     title: str
     id: str
     route: str
     url: str
 
 @dataclass
-class RouterConfig:
-    static_pages: list[StaticPageConfig] | None
+class RouterConfig(DataClassDictMixin):
+    static_pages: list[StaticPageConfig] | None = None
 
 @dataclass
-class WebsiteConfig:
+class WebsiteConfig(DataClassDictMixin):
     seo: SeoConfig
     router: RouterConfig
 
 @dataclass
-class Config:
+class Config(DataClassDictMixin):
     website: WebsiteConfig
     datagouvfr: DatagouvfrConfig
     pages: dict[str, PageConfig]
 
 
-def parse_config() -> tuple[Config, str]:
+def read_cached_config(cache_file: Path) -> dict | None:
+    """Read a cached config, None if it is missing or unusable."""
+    try:
+        return json.loads(cache_file.read_bytes())
+    except FileNotFoundError:
+        return None
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning("-> ignoring unreadable config cache: %s", e)
+        return None
+
+
+def write_atomic(path: Path, content: str):
+    """Write a file through a temporary file, so readers never see it partially written."""
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as f:
+        f.write(content)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        Path(f.name).unlink(missing_ok=True)
+        raise
+
+
+def write_cached_config(cache_file: Path, etag_file: Path, config_dict: dict, etag: str | None):
+    try:
+        # no default=, values JSON can't hold would come back different from the cache
+        content = json.dumps(config_dict)
+    except (TypeError, ValueError) as e:
+        logger.warning("-> config not cached, not JSON serializable: %s", e)
+        etag_file.unlink(missing_ok=True)
+        return
+
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # the etag must never describe another content than the cached one
+        etag_file.unlink(missing_ok=True)
+        write_atomic(cache_file, content)
+        if etag:
+            write_atomic(etag_file, etag)
+    except OSError as e:
+        logger.warning("-> could not cache config: %s", e)
+
+
+def fetch_config_dict(session: requests.Session, gh_url: str, cache_key: str, immutable: bool = False) -> dict:
+    """
+    Fetch and parse the remote config, cached on disk as JSON under cache_key.
+    An immutable cache is used as is, otherwise it is revalidated with its ETag.
+    """
+    cache_file = CACHE_DIR / f"{cache_key}.json"
+    etag_file = CACHE_DIR / f"{cache_key}.etag"
+    headers = {}
+    cached = read_cached_config(cache_file)
+    if cached is not None:
+        if immutable:
+            logger.info("-> config from cache: %r", str(cache_file))
+            return cached
+        try:
+            headers["If-None-Match"] = etag_file.read_text()
+        except OSError:
+            pass
+
+    try:
+        with session.get(gh_url, headers=headers, stream=True) as r:
+            if r.status_code == 304 and cached is not None:
+                logger.info("-> config not modified, from cache: %r", str(cache_file))
+                return cached
+            r.raise_for_status()
+            # parse the body as it arrives, decompressing it if needed
+            r.raw.decode_content = True
+            config_dict = yaml.load(r.raw, Loader=Loader)
+            etag = r.headers.get("ETag")
+    # the loader reads the raw stream, so body errors come straight from urllib3
+    except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        raise ValueError(f"Could not fetch config from {gh_url}: {e}")
+
+    write_cached_config(cache_file, etag_file, config_dict, etag)
+    return config_dict
+
+
+def parse_config(session: requests.Session) -> tuple[Config, str]:
     deploy_env = DeployEnv(os.getenv("ENV"))
-    print(f"-> env: {deploy_env.value!r}")
+    logger.info("-> env: %r", deploy_env.value)
 
     site = os.getenv("SITE")
     if not site:
         raise ValueError("SITE env var not set.")
-    print(f"-> site: {site!r}")
+    logger.info("-> site: %r", site)
 
     # map ecologie to ecospheres if needed
     gh_site = site if site != "ecologie" else "ecospheres"
-    print(f"-> gh_site: {gh_site!r}")
+    logger.info("-> gh_site: %r", gh_site)
 
     git_ref = os.getenv("GIT_REF")
     gh_branch = f"{gh_site}-{deploy_env}" if not git_ref else git_ref
-    gh_url = f"https://raw.githubusercontent.com/opendatateam/udata-front-kit/refs/heads/{gh_branch}/configs/{gh_site}/config.yaml"
-    print(f"-> config url: {gh_url!r}")
-
-    try:
-        r = requests.get(gh_url)
-        r.raise_for_status()
-    except requests.RequestException as e:
-        raise ValueError(f"Could not fetch config from {gh_url}: {e}")
-
-    config_dict = yaml.safe_load(r.text)
-    config = dacite.from_dict(Config, config_dict)
-
-    print(f"-> seo config:\n{yaml.dump(asdict(config.website.seo), default_flow_style=False, indent=2)}")
+    # a commit is addressed directly, and its config never changes
+    is_commit = bool(git_ref and COMMIT_SHA_RE.fullmatch(git_ref))
+    gh_ref = git_ref if is_commit else f"refs/heads/{gh_branch}"
+    gh_url = f"https://raw.githubusercontent.com/opendatateam/udata-front-kit/{gh_ref}/configs/{gh_site}/config.yaml"
+    logger.info("-> config url: %r", gh_url)
+
+    cache_key = f"{gh_ref.removeprefix('refs/heads/').replace('/', '_')}-{gh_site}"
+    config_dict = fetch_config_dict(session, gh_url, cache_key, immutable=is_commit)
+    config = Config.from_dict(config_dict)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        seo_config = yaml.dump(config_dict["website"]["seo"], default_flow_style=False, indent=2, Dumper=Dumper)
+        logger.debug("-> seo config:\n%s", seo_config)
 
     # config object, site/env path like ecologie/prod
     return config, f"{site}/{deploy_env.value}"
@@ -1,22 +1,82 @@
+import functools
+import gzip
+import itertools
+import logging
 import os
+import sys
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 import email.utils
 
 from datetime import datetime, UTC
 from pathlib import Path
-from typing import TypedDict
-from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 
-import boto3
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 from config import parse_config, Config
 
+logger = logging.getLogger(__name__)
 
-class SitemapUrl(TypedDict):
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter applying a default timeout, requests has none."""
+
+    def __init__(self, *args, timeout: float = 30.0, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def get_concurrency() -> int:
+    """Maximum number of concurrent requests, from SITEMAP_CONCURRENCY."""
+    value = os.getenv("SITEMAP_CONCURRENCY", "8")
+    try:
+        concurrency = int(value)
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        raise ValueError(f"SITEMAP_CONCURRENCY env var must be a positive integer, got {value!r}.")
+    return concurrency
+
+
+def create_session(concurrency: int) -> requests.Session:
+    """HTTP session shared by all requests, keeping connections alive."""
+    session = requests.Session()
+    session.headers.update({
+        "User-Agent": "udata-front-kit-seo",
+        "Accept-Encoding": "gzip",
+    })
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=4,
+        # one connection per concurrent request, to each host
+        pool_maxsize=concurrency,
+        # also back off on rate limiting and server errors, honouring Retry-After
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # let raise_for_status report the last response
+            raise_on_status=False,
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@dataclass(slots=True, frozen=True)
+class SitemapUrl:
     url: str
-    last_modified: datetime
+    # ISO 8601, as written in the sitemap
+    last_modified: str
 
 
 @dataclass
@@ -31,54 +91,86 @@ class PageAPI(PageEntry, Enum):
     DATASERVICE = "dataservices_pages", "1/dataservices"
 
 
-def parse_http_date_with_tz(http_date_str: str) -> datetime:
+# only the fields used in the sitemap, applied by the API as a response mask
+API_FIELDS_MASK = "data{slug,last_modified},next_page"
+# fewer, larger pages to cut round trips, unless the universe query sets its own
+API_PAGE_SIZE = 100
+
+
+def parse_http_date_with_tz(http_date_str: str) -> str:
+    """Converts an HTTP date to an ISO 8601 string."""
     dt = email.utils.parsedate_to_datetime(http_date_str)
-    return dt.replace(tzinfo=UTC)
+    return dt.replace(tzinfo=UTC).isoformat()
 
 
-def iter_pages(first_url: str, params: dict = {}):
+def iter_pages(
+    session: requests.Session,
+    first_url: str,
+    params: Mapping[str, object] | None = None,
+    fields_mask: str | None = None,
+):
     """
     Iterate through paginated API results.
     """
-    url = first_url
-    while url:
-        r = requests.get(url, params=params)
-        r.raise_for_status()
-        data = r.json()
-
-        yield from data["data"]
-        url = data["next_page"]
-
-
-def fetch_urls_for_page(page_api: PageAPI, config: Config) -> list[SitemapUrl]:
+    headers = {"X-Fields": fields_mask} if fields_mask else None
+    # fetch the next page in the background while the current one is consumed
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        future = prefetcher.submit(session.get, first_url, params=params, headers=headers)
+        while future:
+            r = future.result()
+            r.raise_for_status()
+            data = orjson.loads(r.content)
+
+            # next_page already carries the query string
+            url = data["next_page"]
+            future = prefetcher.submit(session.get, url, headers=headers) if url else None
+            yield from data["data"]
+
+
+def fetch_urls_for_page(session: requests.Session, page_api: PageAPI, page: str, config: Config) -> list[SitemapUrl]:
+    logger.info("-> %s: %r", page_api.config_key, page)
     results = []
-    for page in (getattr(config.website.seo.sitemap_xml, page_api.config_key) or []):
-        print(f"-> {page_api.config_key}: {page!r}")
-        query = config.pages[page].universe_query
-        for remote_object in iter_pages(f"{config.datagouvfr.base_url}/api/{page_api.api_endpoint}/", params=query):
-            results.append({
-                "url": f"{config.website.seo.canonical_url}/{page}/{remote_object['slug']}",
-                "last_modified": datetime.fromisoformat(remote_object["last_modified"]),
-            })
+    api_url = f"{config.datagouvfr.base_url}/api/{page_api.api_endpoint}/"
+    query = {"page_size": API_PAGE_SIZE, **config.pages[page].universe_query}
+    page_url = f"{config.website.seo.canonical_url}/{page}/"
+    for remote_object in iter_pages(session, api_url, params=query, fields_mask=API_FIELDS_MASK):
+        results.append(SitemapUrl(
+            url=page_url + remote_object["slug"],
+            # the API already returns ISO 8601 dates
+            last_modified=remote_object["last_modified"],
+        ))
     return results
 
 
-def fetch_urls(config: Config) -> list[SitemapUrl]:
-    if not config.website.seo.sitemap_xml:
-        print("-> no sitemap.xml config, skipping")
-        return []
-
-    results: list[SitemapUrl] = []
-
+def fetch_static_url(session: requests.Session, abs_url: str) -> SitemapUrl:
+    # only the headers are needed, no need to download the page body
+    r = session.head(abs_url, allow_redirects=True)
+    if r.status_code == 405:
+        # HEAD not allowed, read the headers of a GET and drop the body
+        with session.get(abs_url, stream=True) as r:
+            pass
+    r.raise_for_status()
+    last_modified = r.headers.get("last-modified")
+    return SitemapUrl(
+        url=abs_url,
+        last_modified=(
+            parse_http_date_with_tz(last_modified) if last_modified else datetime.now(UTC).isoformat()
+        ),
+    )
 
-    # handle topics
-    results += fetch_urls_for_page(PageAPI.TOPIC, config)
 
-    # handle datasets
-    results += fetch_urls_for_page(PageAPI.DATASET, config)
+def fetch_urls(session: requests.Session, config: Config, concurrency: int) -> list[SitemapUrl]:
+    if not config.website.seo.sitemap_xml:
+        logger.info("-> no sitemap.xml config, skipping")
+        return []
 
-    # handle dataservices
-    results += fetch_urls_for_page(PageAPI.DATASERVICE, config)
+    # keyed by url, a page listed twice in the config must not be duplicated
+    results: dict[str, SitemapUrl] = {}
+    # deduplicated, keeping order, so a page listed twice is only walked once
+    pages_per_api = [
+        (page_api, list(dict.fromkeys(getattr(config.website.seo.sitemap_xml, page_api.config_key) or [])))
+        for page_api in PageAPI
+    ]
 
     # handle static pages
     # 1. homepage
@@ -86,44 +178,67 @@ def fetch_urls(config: Config) -> list[SitemapUrl]:
     # 2. static pages
     static_urls += [p.route for p in config.website.router.static_pages or []]
     # 3. objects list pages
-    for page_api in PageAPI:
-        pages = getattr(config.website.seo.sitemap_xml, page_api.config_key) or []
+    for _, pages in pages_per_api:
         static_urls += [f"/{p}" for p in pages]
-    for relative_url in static_urls:
-        abs_url = f"{config.website.seo.canonical_url}{relative_url}"
-        r = requests.get(abs_url)
-        r.raise_for_status()
-        results.append({
-            "url": abs_url,
-            "last_modified": parse_http_date_with_tz(
-                r.headers['last-modified']
-            ),
-        })
 
-    return results
+    # requests are independent, run them concurrently on the shared session,
+    # each task has a single request in flight so this bounds the load on the API
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # handle topics, datasets and dataservices, one pagination walk per page
+        futures = [
+            executor.submit(fetch_urls_for_page, session, page_api, page, config)
+            for page_api, pages in pages_per_api
+            for page in pages
+        ]
+        static_results = executor.map(
+            functools.partial(fetch_static_url, session),
+            # deduplicated, keeping order
+            dict.fromkeys(f"{config.website.seo.canonical_url}{relative_url}" for relative_url in static_urls),
+        )
+        for sitemap_url in itertools.chain(*(future.result() for future in futures), static_results):
+            previous = results.get(sitemap_url.url)
+            # keep the most recent date, parsing only on duplicates
+            if previous is None or (
+                datetime.fromisoformat(sitemap_url.last_modified) > datetime.fromisoformat(previous.last_modified)
+            ):
+                results[sitemap_url.url] = sitemap_url
+
+    return list(results.values())
+
+
+def create_sitemap(urls: list[SitemapUrl], site_env_path: str) -> bytes:
+    """Creates a sitemap XML from a list of URLs, returns its content."""
+    # entries have a fixed shape, render them as text instead of building a tree
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n',
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n',
+    ]
+    for url_data in urls:
+        parts.append(
+            "  <url>\n"
+            f"    <loc>{escape(url_data.url)}</loc>\n"
+            f"    <lastmod>{url_data.last_modified}</lastmod>\n"
+            "  </url>\n"
+        )
+    parts.append("</urlset>\n")
+    content = "".join(parts).encode("utf-8")
 
+    sitemap_file = Path(f"dist/{site_env_path}/sitemap.xml")
+    sitemap_file.write_bytes(content)
+    return content
 
-def create_sitemap(urls: list[SitemapUrl], site_env_path: str) -> str | None:
-    """Creates a sitemap XML from a list of URLs."""
-    sitemap = ElementTree.Element("urlset", {
-        "xmlns": "http://www.sitemaps.org/schemas/sitemap/0.9"
-    })
 
-    for url_data in urls:
-        url_element = ElementTree.SubElement(sitemap, "url")
-        loc = ElementTree.SubElement(url_element, "loc")
-        loc.text = url_data["url"]
-        lastmod = ElementTree.SubElement(url_element, "lastmod")
-        lastmod.text = url_data["last_modified"].isoformat()
+def create_sitemap_gz(sitemap: bytes, site_env_path: str) -> bytes:
+    """Creates the gzipped copy of the sitemap advertised to crawlers, returns its content."""
+    content = gzip.compress(sitemap, compresslevel=6)
 
-    tree = ElementTree.ElementTree(sitemap)
-    ElementTree.indent(tree)
-    Path(f"dist/{site_env_path}").mkdir(parents=True, exist_ok=True)
-    tree.write(f"dist/{site_env_path}/sitemap.xml")
+    sitemap_gz_file = Path(f"dist/{site_env_path}/sitemap.xml.gz")
+    sitemap_gz_file.write_bytes(content)
+    return content
 
 
-def create_robots(config: Config, site_env_path: str, has_sitemap: bool = True):
-    """Creates a robots.txt file."""
+def create_robots(config: Config, site_env_path: str, has_sitemap: bool = True) -> bytes:
+    """Creates a robots.txt file, returns its content."""
     content = "User-agent: *\n"
 
     if config.website.seo.robots_txt:
@@ -133,64 +248,96 @@ def create_robots(config: Config, site_env_path: str, has_sitemap: bool = True):
     if has_sitemap:
         content += f"\nSitemap: {config.website.seo.canonical_url}/sitemap.xml"
 
-    site_env_dir = Path(f"dist/{site_env_path}")
-    site_env_dir.mkdir(parents=True, exist_ok=True)
+    robots_content = content.encode("utf-8")
+
+    robots_file = Path(f"dist/{site_env_path}/robots.txt")
+    robots_file.write_bytes(robots_content)
+    return robots_content
 
-    robots_file = site_env_dir / "robots.txt"
-    robots_file.write_text(content)
 
+@functools.lru_cache(maxsize=1)
+def get_s3_client():
+    """S3 client built once per process, with keep-alive connections."""
+    # boto3 is slow to import and only needed when S3 is configured
+    import boto3
+    from botocore.config import Config as BotoConfig
 
-def send_to_s3(site_env_path: str):
+    return boto3.client(
+        "s3",
+        endpoint_url=os.getenv("AWS_ENDPOINT_URL"),
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        config=BotoConfig(max_pool_connections=32, tcp_keepalive=True),
+    )
+
+
+def send_to_s3(site_env_path: str, sitemap: bytes, sitemap_gz: bytes, robots: bytes):
     s3_endpoint = os.getenv("AWS_ENDPOINT_URL")
     if not s3_endpoint:
-        print("-> S3 not configured, skipping")
+        logger.info("-> S3 not configured, skipping")
         return
 
-    print("-> Sending to S3")
-    user = os.getenv("AWS_ACCESS_KEY_ID")
+    logger.info("-> Sending to S3")
     bucket = os.getenv("AWS_BUCKET", "ufk")
-    s3_client = boto3.client(
-        "s3",
-        endpoint_url=s3_endpoint,
-        aws_access_key_id=user,
-        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    )
-    for seo_file, seo_file_ct in [
-        ("sitemap.xml", "application/xml"),
-        ("robots.txt", "text/plain"),
+    s3_client = get_s3_client()
+    # files are small, upload them from memory instead of reading them back from disk
+    for seo_file, seo_file_ct, seo_file_content in [
+        ("sitemap.xml", "application/xml; charset=utf-8", sitemap),
+        # a plain gzip file, not a transparently decoded copy of the XML
+        ("sitemap.xml.gz", "application/x-gzip", sitemap_gz),
+        ("robots.txt", "text/plain; charset=utf-8", robots),
     ]:
-        s3_client.upload_file(
-            Filename=f"dist/{site_env_path}/{seo_file}",
+        s3_client.put_object(
+            Body=seo_file_content,
             Bucket=bucket,
             Key=f"{site_env_path}/{seo_file}",
-            ExtraArgs={
-                'ContentType': f'{seo_file_ct}; charset=utf-8',
-                'ACL': 'public-read'
-            }
+            ContentType=seo_file_ct,
+            ACL="public-read",
         )
-    print("-> Sent to S3")
+    logger.info("-> Sent to S3")
 
-    print(f"-> Listing contents of bucket '{bucket}':")
+    logger.info("-> Listing contents of bucket '%s':", bucket)
     response = s3_client.list_objects_v2(Bucket=bucket, Prefix=f"{site_env_path}/")
     if "Contents" in response:
         for obj in response["Contents"]:
-            print(
-                f"  - {obj.get('Key')} (Size: {obj.get('Size')} bytes, Modified: {obj.get('LastModified')})"
+            logger.info(
+                "  - %s (Size: %s bytes, Modified: %s)", obj.get("Key"), obj.get("Size"), obj.get("LastModified")
             )
     else:
-        print("  No objects found in bucket")
+        logger.info("  No objects found in bucket")
 
 
 def generate():
-    # this will fail naturally if config is not proper
-    config, site_env_path = parse_config()
-    urls = fetch_urls(config)
-    create_sitemap(urls, site_env_path)
-    print(f"-> Created sitemap.xml with {len(urls)} urls")
-    create_robots(config, site_env_path, has_sitemap=bool(urls))
-    print("-> Created robots.txt")
-    send_to_s3(site_env_path)
+    concurrency = get_concurrency()
+    session = create_session(concurrency)
+    try:
+        # this will fail naturally if config is not proper
+        config, site_env_path = parse_config(session)
+        Path(f"dist/{site_env_path}").mkdir(parents=True, exist_ok=True)
+        urls = fetch_urls(session, config, concurrency)
+        sitemap = create_sitemap(urls, site_env_path)
+        logger.info("-> Created sitemap.xml with %d urls", len(urls))
+        sitemap_gz = create_sitemap_gz(sitemap, site_env_path)
+        logger.info("-> Created sitemap.xml.gz")
+        robots = create_robots(config, site_env_path, has_sitemap=bool(urls))
+        logger.info("-> Created robots.txt")
+        send_to_s3(site_env_path, sitemap, sitemap_gz, robots)
+    finally:
+        session.close()
+
+
+def setup_logging():
+    """
+    Print progress messages to stdout, at the LOG_LEVEL env var level.
+    Must be called before generate() to see them when importing this module.
+    """
+    log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+    if log_level not in logging.getLevelNamesMapping():
+        raise ValueError(f"Invalid LOG_LEVEL env var: {log_level!r}.")
+    # stdout, where the progress messages have always been written
+    logging.basicConfig(level=log_level, format="%(message)s", stream=sys.stdout)
 
 
 if __name__ == "__main__":
+    setup_logging()
     generate()